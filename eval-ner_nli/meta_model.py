@@ -19,6 +19,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 
+import hashlib
 import math
 import os
 import warnings
@@ -349,12 +350,37 @@ class BertMetaDomainEmbed(BertEmbed, AutoTokenizer):
         self.use_feature = use_feature
         self.ignore_tod = ignore_tod
         self.num_embeddings = sum(x is not None for x in [self.embedding_1, self.embedding_2, self.embedding_3, self.embedding_4, self.embedding_5, self.embedding_6])
+        # Embeddings whose tokenizers are identical share a single tokenization of the batch in the forward pass
+        self.tokenizer_groups = self.group_tokenizers([self.tokenizer_1, self.tokenizer_2, self.tokenizer_3, self.tokenizer_4, self.tokenizer_5, self.tokenizer_6])
         #self.cpu()
         #self._init_adapter_modules()
         #self.init_weights()
         if torch.cuda.is_available():
             self.cuda()
     
+    def tokenizer_signature(self, tokenizer):
+        serialized = tokenizer.backend_tokenizer.to_str()
+        return (type(tokenizer).__name__, len(tokenizer), hashlib.md5(serialized.encode()).hexdigest())
+    
+    def group_tokenizers(self, tokenizers):
+        # Map each tokenizer to the index of the first tokenizer with the same signature
+        canonical = {}
+        groups = []
+        for i, tokenizer in enumerate(tokenizers):
+            if tokenizer is None:
+                groups.append(None)
+            else:
+                groups.append(canonical.setdefault(self.tokenizer_signature(tokenizer), i))
+        return groups
+    
+    def embed_batch(self, index, batch_texts, max_length, tokenized):
+        # Tokenize once per group of identical tokenizers, `tokenized` caches the results for the current batch
+        batch_tensor = BatchTensor(getattr(self, "embedding_{}".format(index + 1)), getattr(self, "tokenizer_{}".format(index + 1)))
+        group = self.tokenizer_groups[index]
+        if group not in tokenized:
+            tokenized[group] = batch_tensor.tokenize(batch_texts, max_length=max_length)
+        return batch_tensor.convert(batch_texts, max_length=max_length, tokenized=tokenized[group])
+    
     def convert_offsets_to_tuple(self, pt_batch, tokenizer):
         return_offsets = []
         return_toks = []
@@ -474,27 +500,22 @@ class BertMetaDomainEmbed(BertEmbed, AutoTokenizer):
         device = "cuda:0" if torch.cuda.is_available() else "cpu"
         
         batch_texts = self.prepare_batch_text(kwargs, self.tokenizer_1, method=self.method) #Convert the tokenized input_ids into texts
-        
-        batch_tensor = BatchTensor(self.embedding_1, self.tokenizer_1)
-        embedding_1_output, embedding_1_convert_offsets = batch_tensor.convert(batch_texts, max_length=kwargs["input_ids"].shape[1])
-        batch_tensor = BatchTensor(self.embedding_2, self.tokenizer_2)
-        embedding_2_output, embedding_2_convert_offsets = batch_tensor.convert(batch_texts, max_length=kwargs["input_ids"].shape[1])
+        max_length = kwargs["input_ids"].shape[1]
+        tokenized = {}
+        embedding_1_output, embedding_1_convert_offsets = self.embed_batch(0, batch_texts, max_length, tokenized)
+        embedding_2_output, embedding_2_convert_offsets = self.embed_batch(1, batch_texts, max_length, tokenized)
         embs = list(zip(embedding_1_convert_offsets, embedding_2_convert_offsets))
         if self.embedding_3 is not None:
-            batch_tensor = BatchTensor(self.embedding_3, self.tokenizer_3)
-            embedding_3_output, embedding_3_convert_offsets = batch_tensor.convert(batch_texts, max_length=kwargs["input_ids"].shape[1])
+            embedding_3_output, embedding_3_convert_offsets = self.embed_batch(2, batch_texts, max_length, tokenized)
             embs = list(zip(embedding_1_convert_offsets, embedding_2_convert_offsets, embedding_3_convert_offsets))
         if self.embedding_4 is not None:
-            batch_tensor = BatchTensor(self.embedding_4, self.tokenizer_4)
-            embedding_4_output, embedding_4_convert_offsets = batch_tensor.convert(batch_texts, max_length=kwargs["input_ids"].shape[1])
+            embedding_4_output, embedding_4_convert_offsets = self.embed_batch(3, batch_texts, max_length, tokenized)
             embs = list(zip(embedding_1_convert_offsets, embedding_2_convert_offsets, embedding_3_convert_offsets, embedding_4_convert_offsets))
         if self.embedding_5 is not None:
-            batch_tensor = BatchTensor(self.embedding_5, self.tokenizer_5)
-            embedding_5_output, embedding_5_convert_offsets = batch_tensor.convert(batch_texts, max_length=kwargs["input_ids"].shape[1])
+            embedding_5_output, embedding_5_convert_offsets = self.embed_batch(4, batch_texts, max_length, tokenized)
             embs = list(zip(embedding_1_convert_offsets, embedding_2_convert_offsets, embedding_3_convert_offsets, embedding_4_convert_offsets, embedding_5_convert_offsets))
         if self.embedding_6 is not None:
-            batch_tensor = BatchTensor(self.embedding_6, self.tokenizer_6)
-            embedding_6_output, embedding_6_convert_offsets = batch_tensor.convert(batch_texts, max_length=kwargs["input_ids"].shape[1])
+            embedding_6_output, embedding_6_convert_offsets = self.embed_batch(5, batch_texts, max_length, tokenized)
             embs = list(zip(embedding_1_convert_offsets, embedding_2_convert_offsets, embedding_3_convert_offsets, embedding_4_convert_offsets, embedding_5_convert_offsets, embedding_6_convert_offsets))
         
         if self.method == "orig_subword":
@@ -520,7 +541,8 @@ class BertMetaDomainEmbed(BertEmbed, AutoTokenizer):
         
         stack_embeddings = torch.stack([embedding_1_output, embedding_2_output, embedding_3_output, embedding_4_output, embedding_5_output, embedding_6_output], dim=1)
             
-        emb_all = torch.zeros(stack_embeddings.shape)
+        # The frozen embeddings may be kept in half precision.
+        emb_all = torch.zeros(stack_embeddings.shape, dtype=self.dtype)
         if self.method in ["orig_subword", "orig_whitespace"]:
         # Stack six of them
             for k in range(len(final_combine)):
@@ -623,6 +645,8 @@ class BertMetaEmbed(BertEmbed):
                 emb_all = torch.stack((self.embedding_2_output, self.embedding_3_output, self.embedding_4_output, self.embedding_5_output, self.embedding_6_output))
             else:
                 emb_all = torch.stack((self.embedding_2_output, self.embedding_3_output, self.embedding_4_output, self.embedding_5_output))
+        # The frozen embeddings may be kept in half precision.
+        emb_all = emb_all.to(self.dtype)
             
         # The input should be the same as the results of tokenizer(input_sequences)
         if self.use_attention:
@@ -634,7 +658,7 @@ class BertMetaEmbed(BertEmbed):
             #print("Use Average")
             embedding_output = torch.mean(emb_all, dim=0)
         else:
-            embedding_output = self.embedding_1_output
+            embedding_output = self.embedding_1_output.to(self.dtype)
         return embedding_output
     
 
@@ -713,10 +737,15 @@ class BatchTensor:
             return_offsets.append(list(zip(toks, word_ids, input_ids, offset_tuple)))
         return return_offsets
     
-    def convert(self, batch_texts, max_length=128):
+    def tokenize(self, batch_texts, max_length=128):
         batch_tensor = self.prepare_batch(batch_texts, padding="max_length", 
                         truncation=True, max_length=max_length, return_tensors="pt", is_split_into_words=False, 
                         return_attention_mask=False, return_offsets_mapping=True)
-        embedding_output = self.embedding(**batch_tensor)
         convert_offsets = self.convert_offsets_to_tuple(batch_tensor)
+        return batch_tensor, convert_offsets
+    
+    def convert(self, batch_texts, max_length=128, tokenized=None):
+        # `tokenized` may hold the result of `tokenize` for an identical tokenizer
+        batch_tensor, convert_offsets = tokenized if tokenized is not None else self.tokenize(batch_texts, max_length=max_length)
+        embedding_output = self.embedding(**batch_tensor)
         return embedding_output, convert_offsets
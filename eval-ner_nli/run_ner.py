@@ -15,15 +15,22 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
+import itertools
 import logging
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
 from typing import Optional
 
 import datasets
+import numba
 import numpy as np
-from datasets import ClassLabel, load_dataset, load_metric
+import pyarrow.compute as pc
+import torch
+from torch.utils.data import DataLoader, IterableDataset
+from datasets import ClassLabel, Features, Sequence, Value, concatenate_datasets, load_dataset, load_metric
+from datasets.fingerprint import Hasher
 
 import transformers
 import transformers.adapters.composition as ac
@@ -55,6 +62,184 @@ require_version("datasets>=1.8.0", "To fix: pip install -r examples/pytorch/toke
 logger = logging.getLogger(__name__)
 
 
+@numba.njit(cache=True, boundscheck=False)
+def align_labels(word_ids, word_labels, label_lut, label_all_tokens):
+    """
+    Align the word-level labels of a whole batch with its tokens.
+
+    `word_ids` holds, for every token of the flattened batch, the index of its word in `word_labels` or -1 for special
+    tokens. `word_labels` holds the position of every word's label in `label_lut`, which maps it to the label id.
+    Special tokens get the label -100 so they are automatically ignored in the loss function, as do the non-first
+    tokens of a word unless `label_all_tokens` is set.
+    """
+    label_ids = np.full(word_ids.shape[0], -100, dtype=np.int16)
+    previous_word_idx = -1
+    for i in range(word_ids.shape[0]):
+        word_idx = word_ids[i]
+        if word_idx >= 0 and (word_idx != previous_word_idx or label_all_tokens):
+            label_ids[i] = label_lut[word_labels[word_idx]]
+        previous_word_idx = word_idx
+    return label_ids
+
+
+# Compile (or load from the cache) once at import so that the JIT cost does not hit the first batch.
+align_labels(np.zeros(1, dtype=np.int32), np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int16), False)
+
+
+def load_in_parallel(load, paths, **kwargs):
+    """
+    Call `load(path, **kwargs)` for every path from a thread pool and return the results in the order of `paths`, with
+    None for the paths that are None. Loading pretrained models is dominated by disk I/O, so the loads overlap well.
+    """
+    with ThreadPoolExecutor(max_workers=max(1, sum(path is not None for path in paths))) as executor:
+        futures = [None if path is None else executor.submit(load, path, **kwargs) for path in paths]
+        return [None if future is None else future.result() for future in futures]
+
+
+def load_frozen_embeddings(paths, cache_dir=None, half_precision=False, compile_embeddings=False):
+    """
+    Load the `BertEmbed` sub-models of a meta embedding. They are frozen and only produce embeddings, so with
+    `half_precision` (for runs on GPU) they are kept in half precision; the meta embedding casts its combined output
+    back to the model dtype. With `compile_embeddings`, their forward passes are compiled with `torch.compile`; the
+    rest of the model stays eager.
+    """
+    embeddings = load_in_parallel(BertEmbed.from_pretrained, paths, cache_dir=cache_dir)
+    if half_precision:
+        dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        embeddings = [None if embedding is None else embedding.to(dtype=dtype) for embedding in embeddings]
+    if compile_embeddings:
+        if hasattr(torch, "compile"):
+            # Fall back to eager execution instead of failing the run when a sub-model cannot be compiled.
+            torch._dynamo.config.suppress_errors = True
+            for embedding in embeddings:
+                if embedding is not None:
+                    # Compiling the bound forward keeps the module and its state dict keys unchanged. Batches are
+                    # padded to their own length, so the sequence length is left to be marked dynamic after it changes
+                    # instead of recompiling (and recording a CUDA graph) for every new length.
+                    embedding.forward = torch.compile(embedding.forward, dynamic=None)
+        else:
+            logger.warning(f"torch.compile is not available in PyTorch {torch.__version__}, embeddings run eagerly.")
+    return embeddings
+
+
+def map_in_shards(dataset, function, num_shards=None, new_fingerprint=None, **map_kwargs):
+    """
+    Apply `dataset.map(function, **map_kwargs)` to `num_shards` contiguous shards of the dataset one after the other
+    and concatenate the results. Every shard is written to its own cache file, which bounds the memory a map holds.
+    The fingerprint of every shard is derived from `new_fingerprint` when it is given.
+    """
+    num_shards = min(num_shards or 1, len(dataset))
+    if num_shards <= 1:
+        return dataset.map(function, new_fingerprint=new_fingerprint, **map_kwargs)
+    return concatenate_datasets(
+        [
+            dataset.shard(num_shards=num_shards, index=index, contiguous=True).map(
+                function,
+                new_fingerprint=None if new_fingerprint is None else Hasher.hash([new_fingerprint, num_shards, index]),
+                **map_kwargs,
+            )
+            for index in range(num_shards)
+        ]
+    )
+
+
+def freeze_meta_embeddings(model):
+    """
+    Freeze the sub-models of a meta embedding in a single pass over the BERT parameters, logging whether each one is
+    trainable at debug level.
+    """
+    log_params = logger.isEnabledFor(logging.DEBUG)
+    for name, param in model.bert.named_parameters():
+        if "embedding_" in name:
+            param.requires_grad = False
+        if log_params:
+            logger.debug(f"Param: {name} Requires_grad: {param.requires_grad}")
+
+
+class PrefetchingDataLoaderMixin:
+    """
+    Rebuilds the data loaders of a `Trainer` so that their worker processes prefetch more batches while the model
+    runs. The workers of the training data loader are kept alive across epochs.
+    """
+
+    def _prefetching_dataloader(self, dataloader, persistent_workers=False):
+        if isinstance(dataloader.dataset, IterableDataset) or dataloader.num_workers == 0:
+            return dataloader
+        return DataLoader(
+            dataloader.dataset,
+            batch_size=dataloader.batch_size,
+            sampler=dataloader.sampler,
+            collate_fn=dataloader.collate_fn,
+            drop_last=dataloader.drop_last,
+            num_workers=dataloader.num_workers,
+            pin_memory=dataloader.pin_memory,
+            prefetch_factor=4,
+            persistent_workers=persistent_workers,
+        )
+
+    def get_train_dataloader(self):
+        return self._prefetching_dataloader(super().get_train_dataloader(), persistent_workers=True)
+
+    def get_eval_dataloader(self, eval_dataset=None):
+        return self._prefetching_dataloader(super().get_eval_dataloader(eval_dataset))
+
+    def get_test_dataloader(self, test_dataset):
+        return self._prefetching_dataloader(super().get_test_dataloader(test_dataset))
+
+
+class PrefetchingTrainer(PrefetchingDataLoaderMixin, Trainer):
+    pass
+
+
+class PrefetchingAdapterTrainer(PrefetchingDataLoaderMixin, AdapterTrainer):
+    pass
+
+
+@dataclass
+class TensorCopyTokenClassificationCollator(DataCollatorForTokenClassification):
+    """
+    Data collator that pads a batch by copying every sequence into a tensor filled with the padding value, sized to the
+    longest sequence of the batch rounded up to `pad_to_multiple_of`. This avoids the per-example Python padding of
+    `tokenizer.pad` and of the labels in `DataCollatorForTokenClassification`, which it falls back to for other
+    padding strategies, an explicit `max_length` and features it does not know how to pad.
+    """
+
+    def __post_init__(self):
+        # The padding values and side are looked up on the tokenizer once instead of for every batch.
+        self.pad_values = {
+            "input_ids": self.tokenizer.pad_token_id,
+            "token_type_ids": self.tokenizer.pad_token_type_id,
+            "attention_mask": 0,
+            "labels": self.label_pad_token_id,
+        }
+        self.pad_right = self.tokenizer.padding_side == "right"
+
+    def __call__(self, features):
+        pad_values = self.pad_values
+        if (
+            self.return_tensors != "pt"
+            or self.padding not in (True, "longest")
+            or self.max_length is not None
+            or any(key not in pad_values for key in features[0])
+        ):
+            return super().__call__(features)
+
+        length = max(len(feature["input_ids"]) for feature in features)
+        if self.pad_to_multiple_of is not None:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        batch = {}
+        for key in features[0]:
+            values = torch.full((len(features), length), pad_values[key], dtype=torch.long)
+            for row, feature in zip(values, features):
+                sequence = torch.as_tensor(feature[key])
+                if self.pad_right:
+                    row[: len(sequence)] = sequence
+                else:
+                    row[length - len(sequence) :] = sequence
+            batch[key] = values
+        return batch
+
+
 @dataclass
 class ModelArguments:
     """
@@ -121,6 +306,14 @@ class ModelArguments:
             "help": "Which subword aggregation method to use: subword, whitespace"
         },
     )
+    compile_embeddings: bool = field(
+        default=False,
+        metadata={
+            "help": "Whether to compile the frozen meta embedding models with torch.compile (requires PyTorch 2.0). "
+            "Batches are padded to their own length, so the models are compiled for dynamic sequence lengths; use "
+            "--pad_to_max_length for a single static shape."
+        },
+    )
     model_name_or_path_2: str = field(
         default=None, metadata={"help": "Path to pretrained model or model identifier from huggingface.co/models"}
     )
@@ -171,8 +364,24 @@ class DataTrainingArguments:
         default=False, metadata={"help": "Overwrite the cached training and evaluation sets"}
     )
     preprocessing_num_workers: Optional[int] = field(
+        default=min(os.cpu_count() or 1, 8),
+        metadata={
+            "help": "The number of processes to use for the preprocessing. Defaults to the number of CPUs, up to 8."
+        },
+    )
+    preprocessing_num_shards: Optional[int] = field(
         default=None,
-        metadata={"help": "The number of processes to use for the preprocessing."},
+        metadata={
+            "help": "If set, tokenize every dataset in this many contiguous shards, each mapped and cached on its "
+            "own, to bound the memory used by the preprocessing of large datasets."
+        },
+    )
+    auto_dataloader_num_workers: bool = field(
+        default=True,
+        metadata={
+            "help": "Whether to use min(4, half the CPUs) data loader worker processes when --dataloader_num_workers "
+            "is left at 0. Pass --no_auto_dataloader_num_workers to load the data in the main process."
+        },
     )
     max_seq_length: int = field(
         default=None,
@@ -341,11 +550,8 @@ def main():
     # In the event the labels are not a `Sequence[ClassLabel]`, we will need to go through the dataset to get the
     # unique labels.
     def get_label_list(labels):
-        unique_labels = set()
-        for label in labels:
-            unique_labels = unique_labels | set(label)
-        label_list = list(unique_labels)
-        label_list.sort()
+        # Deduplicate on the Arrow buffers of the column instead of materializing it as Python lists.
+        label_list = sorted(pc.unique(pc.list_flatten(labels)).to_pylist())
         return label_list
 
     if isinstance(features[label_column_name].feature, ClassLabel):
@@ -353,9 +559,15 @@ def main():
         # No need to convert the labels since they are already ints.
         label_to_id = {i: i for i in range(len(label_list))}
     else:
-        label_list = get_label_list(raw_datasets["train"][label_column_name])
+        label_list = get_label_list(raw_datasets["train"].data.column(label_column_name))
         label_to_id = {l: i for i, l in enumerate(label_list)}
     num_labels = len(label_list)
+    # Lookup table from the raw labels of the dataset to their ids: the raw values are located by binary search in
+    # `label_keys` and their ids gathered from `label_to_id_arr`.
+    label_keys = np.asarray(sorted(label_to_id))
+    label_to_id_arr = np.fromiter((label_to_id[k] for k in label_keys.tolist()), dtype=np.int16, count=num_labels)
+    # Label names by id as an object array, so predicted ids are decoded to names with a single gather.
+    label_arr = np.asarray(label_list, dtype=object)
     
     print(label_list)
     # Load pretrained model and tokenizer
@@ -388,17 +600,30 @@ def main():
         if "financial/BERT_MLM_EMB_ONLY_TOKENIZER" in tokenizer_name_or_path:
             print("Load financial tokenizer")
             tokenizer_name_or_path = "./cache/transformer/tokenizer/background-x/bert-base-uncased/financial"
-            tokenizer = AutoTokenizer.from_pretrained(
-                tokenizer_name_or_path,
-                cache_dir=model_args.cache_dir,
-                use_fast=True,
-                revision=model_args.model_revision,
-                use_auth_token=True if model_args.use_auth_token else None,
-            )
-            print(len(tokenizer.vocab))
-            with open(tokenizer_name_or_path+"/vocab_new.txt") as file:
-                new_vocab = [line.rstrip() for line in file]
-            tokenizer.add_tokens(new_vocab)
+            vocab_file = os.path.join(tokenizer_name_or_path, "vocab_new.txt")
+            # The extended tokenizer is saved once and reloaded as long as it is newer than the new vocabulary, which
+            # skips merging the new tokens into the vocabulary on every run.
+            extended_tokenizer_path = os.path.join(model_args.cache_dir or tokenizer_name_or_path, "financial_extended")
+            extended_tokenizer_file = os.path.join(extended_tokenizer_path, "tokenizer.json")
+            with training_args.main_process_first(desc="financial tokenizer extension"):
+                cache_is_fresh = os.path.isfile(extended_tokenizer_file) and (
+                    os.path.getmtime(extended_tokenizer_file) >= os.path.getmtime(vocab_file)
+                )
+                if cache_is_fresh:
+                    tokenizer = AutoTokenizer.from_pretrained(extended_tokenizer_path, use_fast=True)
+                else:
+                    tokenizer = AutoTokenizer.from_pretrained(
+                        tokenizer_name_or_path,
+                        cache_dir=model_args.cache_dir,
+                        use_fast=True,
+                        revision=model_args.model_revision,
+                        use_auth_token=True if model_args.use_auth_token else None,
+                    )
+                    print(len(tokenizer.vocab))
+                    with open(vocab_file) as file:
+                        new_vocab = file.read().splitlines()
+                    tokenizer.add_tokens(new_vocab)
+                    tokenizer.save_pretrained(extended_tokenizer_path)
             print(len(tokenizer.vocab))
         else:  
             tokenizer = AutoTokenizer.from_pretrained(
@@ -417,13 +642,21 @@ def main():
         revision=model_args.model_revision,
         use_auth_token=True if model_args.use_auth_token else None,
     )
+    meta_model_paths = [
+        model_args.model_name_or_path,  # bert
+        model_args.model_name_or_path_2,  # bert-MLMEMB-SAMEDOMAIN
+        model_args.model_name_or_path_3,  # bert-MLMEMB--OTHERDOMAIN
+        model_args.model_name_or_path_4,  # bert-MLMEMB--OTHERDOMAIN
+        model_args.model_name_or_path_5,  # bert-MLMEMB--OTHERDOMAIN
+        model_args.model_name_or_path_6,  # bert-MLMEMB--OTHERDOMAIN
+    ]
     if model_args.use_metaemb:
-        embedding_1 = BertEmbed.from_pretrained(model_args.model_name_or_path, cache_dir = model_args.cache_dir) #bert
-        embedding_2 = BertEmbed.from_pretrained(model_args.model_name_or_path_2, cache_dir = model_args.cache_dir) #bert-MLMEMB-SAMEDOMAIN
-        embedding_3 = None if model_args.model_name_or_path_3==None else BertEmbed.from_pretrained(model_args.model_name_or_path_3, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
-        embedding_4 = None if model_args.model_name_or_path_4==None else BertEmbed.from_pretrained(model_args.model_name_or_path_4, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
-        embedding_5 = None if model_args.model_name_or_path_5==None else BertEmbed.from_pretrained(model_args.model_name_or_path_5, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
-        embedding_6 = None if model_args.model_name_or_path_6==None else BertEmbed.from_pretrained(model_args.model_name_or_path_6, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
+        embedding_1, embedding_2, embedding_3, embedding_4, embedding_5, embedding_6 = load_frozen_embeddings(
+            meta_model_paths,
+            cache_dir=model_args.cache_dir,
+            half_precision=training_args.device.type == "cuda",
+            compile_embeddings=model_args.compile_embeddings,
+        )
         print("embedding 1: {}".format(model_args.model_name_or_path))
         print("embedding 2: {}".format(model_args.model_name_or_path_2))
         print("embedding 3: {}".format(model_args.model_name_or_path_3))
@@ -444,23 +677,40 @@ def main():
         print("Use Attention: {}".format(model.bert.embeddings.use_attention))
         print("Use Average: {}".format(model.bert.embeddings.use_average))
         print("Ignore BERT: {}".format(model.bert.embeddings.ignore_tod))
-        for param in model.bert.named_parameters():
-            if "embedding_" in param[0]:
-                param[1].requires_grad=False
-        for param in model.bert.named_parameters():
-            print("Param: {} Requires_grad: {}".format(param[0], param[1].requires_grad))
+        freeze_meta_embeddings(model)
         print(model)
         
     elif model_args.use_domain_metaemb:
-        embedding_1 = BertEmbed.from_pretrained(model_args.model_name_or_path, cache_dir = model_args.cache_dir) #bert
-        embedding_2 = BertEmbed.from_pretrained(model_args.model_name_or_path_2, cache_dir = model_args.cache_dir) #bert-MLMEMB-SAMEDOMAIN
-        embedding_3 = None if model_args.model_name_or_path_3==None else BertEmbed.from_pretrained(model_args.model_name_or_path_3, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
-        embedding_4 = None if model_args.model_name_or_path_4==None else BertEmbed.from_pretrained(model_args.model_name_or_path_4, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
-        embedding_5 = None if model_args.model_name_or_path_5==None else BertEmbed.from_pretrained(model_args.model_name_or_path_5, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
-        embedding_6 = None if model_args.model_name_or_path_6==None else BertEmbed.from_pretrained(model_args.model_name_or_path_6, cache_dir = model_args.cache_dir) #bert-MLMEMB--OTHERDOMAIN
-
-        tokenizer_1 = AutoTokenizer.from_pretrained(model_args.model_name_or_path, cache_dir = model_args.cache_dir)
-        if "financial/BERT_MLM_EMB_ONLY_TOKENIZER" in model_args.model_name_or_path_2:
+        embedding_1, embedding_2, embedding_3, embedding_4, embedding_5, embedding_6 = load_frozen_embeddings(
+            meta_model_paths,
+            cache_dir=model_args.cache_dir,
+            half_precision=training_args.device.type == "cuda",
+            compile_embeddings=model_args.compile_embeddings,
+        )
+
+        use_financial_tokenizer = "financial/BERT_MLM_EMB_ONLY_TOKENIZER" in model_args.model_name_or_path_2
+        tokenizer_paths = list(meta_model_paths)
+        if use_financial_tokenizer:
+            tokenizer_paths[1] = None
+        # Load every tokenizer path only once. The first slot reuses the tokenizer built above when it is the plain
+        # tokenizer of `model_name_or_path` and is not extended with the financial vocabulary below.
+        loaded_tokenizers = {}
+        if (
+            tokenizer_name_or_path == model_args.model_name_or_path
+            and config.model_type not in {"gpt2", "roberta"}
+            and not use_financial_tokenizer
+        ):
+            loaded_tokenizers[model_args.model_name_or_path] = tokenizer
+        new_paths = [
+            path for path in dict.fromkeys(tokenizer_paths) if path is not None and path not in loaded_tokenizers
+        ]
+        loaded_tokenizers.update(
+            zip(new_paths, load_in_parallel(AutoTokenizer.from_pretrained, new_paths, cache_dir=model_args.cache_dir))
+        )
+        tokenizer_1, tokenizer_2, tokenizer_3, tokenizer_4, tokenizer_5, tokenizer_6 = [
+            None if path is None else loaded_tokenizers[path] for path in tokenizer_paths
+        ]
+        if use_financial_tokenizer:
             print("Load financial tokenizer")
             tokenizer_name_or_path = "./cache/transformer/tokenizer/background-x/bert-base-uncased/financial"
             tokenizer_2 = AutoTokenizer.from_pretrained(
@@ -472,15 +722,13 @@ def main():
             )
             print(len(tokenizer.vocab))
             with open(tokenizer_name_or_path+"/vocab_new.txt") as file:
-                new_vocab = [line.rstrip() for line in file]
-            tokenizer.add_tokens(new_vocab)
+                new_vocab = file.read().splitlines()
+            # Tokens that were already added are skipped to avoid needlessly rebuilding the vocabulary.
+            added_vocab = tokenizer.get_added_vocab()
+            new_vocab = [token for token in new_vocab if token not in added_vocab]
+            if new_vocab:
+                tokenizer.add_tokens(new_vocab)
             print(len(tokenizer.vocab))
-        else:
-            tokenizer_2 = AutoTokenizer.from_pretrained(model_args.model_name_or_path_2, cache_dir = model_args.cache_dir)
-        tokenizer_3 = None if model_args.model_name_or_path_3==None else AutoTokenizer.from_pretrained(model_args.model_name_or_path_3, cache_dir = model_args.cache_dir)
-        tokenizer_4 = None if model_args.model_name_or_path_4==None else AutoTokenizer.from_pretrained(model_args.model_name_or_path_4, cache_dir = model_args.cache_dir)
-        tokenizer_5 = None if model_args.model_name_or_path_5==None else AutoTokenizer.from_pretrained(model_args.model_name_or_path_5, cache_dir = model_args.cache_dir)
-        tokenizer_6 = None if model_args.model_name_or_path_6==None else AutoTokenizer.from_pretrained(model_args.model_name_or_path_6, cache_dir = model_args.cache_dir)
         
         print("embedding/tokenizer 1: {}".format(model_args.model_name_or_path))
         print("embedding/tokenizer 2: {}".format(model_args.model_name_or_path_2))
@@ -510,11 +758,7 @@ def main():
         print("Use Attention: {}".format(model.bert.embeddings.use_attention))
         print("Use Average: {}".format(model.bert.embeddings.use_average))
         print("Ignore BERT: {}".format(model.bert.embeddings.ignore_tod))
-        for param in model.bert.named_parameters():
-            if "embedding_" in param[0]:
-                param[1].requires_grad=False
-        for param in model.bert.named_parameters():
-            print("Param: {} Requires_grad: {}".format(param[0], param[1].requires_grad))
+        freeze_meta_embeddings(model)
         print(model)
         
 
@@ -596,54 +840,107 @@ def main():
             max_length=data_args.max_seq_length,
             # We use this argument because the texts in our dataset are lists of words (with a label for each word).
             is_split_into_words=True,
-            #return_offsets_mapping = True
+            return_offsets_mapping=False,
+            return_special_tokens_mask=False,
+            # Token type ids are only stored for the models that take them (e.g. BERT, but not RoBERTa).
+            return_token_type_ids="token_type_ids" in tokenizer.model_input_names,
         )
-        labels = []
-        for i, label in enumerate(examples[label_column_name]):
-            word_ids = tokenized_inputs.word_ids(batch_index=i)
-            previous_word_idx = None
-            label_ids = []
-            for word_idx in word_ids:
-                # Special tokens have a word id that is None. We set the label to -100 so they are automatically
-                # ignored in the loss function.
-                if word_idx is None:
-                    label_ids.append(-100)
-                # We set the label for the first token of each word.
-                elif word_idx != previous_word_idx:
-                    label_ids.append(label_to_id[label[word_idx]])
-                # For the other tokens in a word, we set the label to either the current label or -100, depending on
-                # the label_all_tokens flag.
-                else:
-                    label_ids.append(label_to_id[label[word_idx]] if data_args.label_all_tokens else -100)
-                previous_word_idx = word_idx
-            labels.append(label_ids)
-        # offsets_start = []
-        # offsets_end = []
-        # if "offset_mapping" in tokenized_inputs.keys():
-        #     for k in tokenized_inputs["offset_mapping"]:
-        #         start = [item[0] for item in k] #list(sum(k, ())) #[tuple(item) for item in k]
-        #         offsets_start.append(start)
-        #         end = [item[1] for item in k] #list(sum(k, ())) #[tuple(item) for item in k]
-        #         offsets_end.append(end)
-        # tokenized_inputs["offset_mapping_start"] = offsets_start
-        # tokenized_inputs["offset_mapping_end"] = offsets_end
+        # The labels of the whole batch are aligned in a single pass: word ids are shifted by the number of words in
+        # the preceding examples so that they index into the flattened `label_positions` directly.
+        batch_labels = examples[label_column_name]
+        # Read the word ids straight off the encodings of the fast tokenizer.
+        batch_word_ids = [encoding.word_ids for encoding in tokenized_inputs.encodings]
+        # The label column is formatted as NumPy arrays (see `tokenize_split`), so the batch is joined without boxing.
+        raw_labels = np.concatenate(batch_labels) if len(batch_labels) else label_keys[:0]
+        label_positions = np.minimum(np.searchsorted(label_keys, raw_labels), num_labels - 1)
+        unknown_labels = label_keys[label_positions] != raw_labels
+        if unknown_labels.any():
+            raise KeyError(raw_labels[unknown_labels][0])
+        num_words = np.fromiter(map(len, batch_labels), dtype=np.int64, count=len(batch_labels))
+        num_tokens = np.fromiter(map(len, batch_word_ids), dtype=np.int64, count=len(batch_word_ids))
+        # Special tokens have a word id that is None, which numpy converts to NaN in a float array.
+        word_ids = np.array(list(itertools.chain.from_iterable(batch_word_ids)), dtype=np.float64)
+        word_offsets = np.repeat(np.cumsum(num_words) - num_words, num_tokens)
+        word_ids = np.where(np.isnan(word_ids), -1, word_ids + word_offsets).astype(np.int32)
+        if data_args.label_all_tokens:
+            # Every token of a word gets its label, so no first-token tracking is needed and a gather suffices.
+            label_ids = np.full(word_ids.shape[0], -100, dtype=np.int16)
+            is_word = word_ids >= 0
+            label_ids[is_word] = label_to_id_arr[label_positions[word_ids[is_word]]]
+        else:
+            label_ids = align_labels(word_ids, label_positions, label_to_id_arr, False)
+        bounds = np.concatenate(([0], np.cumsum(num_tokens)))
+        labels = [label_ids[start:end].tolist() for start, end in zip(bounds[:-1], bounds[1:])]
         tokenized_inputs["labels"] = labels
+        # Precomputed lengths let `--group_by_length` batch similar lengths together without reading every example.
+        tokenized_inputs[training_args.length_column_name] = [len(ids) for ids in tokenized_inputs["input_ids"]]
         return tokenized_inputs
 
+    def tokenized_features(dataset):
+        # Narrow integer types keep the cached Arrow files small; the data collator still builds int64 tensors.
+        features = Features(dataset.features.copy())
+        features["input_ids"] = Sequence(Value("int32"))
+        if "token_type_ids" in tokenizer.model_input_names:
+            features["token_type_ids"] = Sequence(Value("int8"))
+        if "attention_mask" in tokenizer.model_input_names:
+            features["attention_mask"] = Sequence(Value("int8"))
+        features["labels"] = Sequence(Value("int16"))
+        features[training_args.length_column_name] = Value("int32")
+        return features
+
+    def tokenization_fingerprint(dataset):
+        """
+        Fingerprint of the tokenized `dataset`, built from everything that determines its content. The map function
+        cannot be hashed by `datasets` here: it calls the Numba dispatcher of `align_labels`, whose pickled state holds
+        a random id per process, so the cache of `map` would never be hit.
+        """
+        return Hasher.hash(
+            [
+                dataset._fingerprint,
+                tokenizer,
+                label_to_id,
+                text_column_name,
+                label_column_name,
+                training_args.length_column_name,
+                data_args.max_seq_length,
+                data_args.pad_to_max_length,
+                data_args.label_all_tokens,
+                tokenize_and_align_labels.__code__,
+                align_labels.py_func.__code__,
+            ]
+        )
+
+    def tokenize_split(dataset, desc):
+        """
+        Tokenizes a split under the deterministic fingerprint of its tokenization, so that later runs with the same
+        data, tokenizer and preprocessing arguments load it from the cache of `map`.
+        """
+        fingerprint = tokenization_fingerprint(dataset)
+        with training_args.main_process_first(desc=f"{desc} dataset map pre-processing"):
+            # Only the labels are read as NumPy arrays: the tokenizer needs the words as lists of strings.
+            dataset = dataset.with_format("numpy", columns=[label_column_name], output_all_columns=True)
+            tokenized_dataset = map_in_shards(
+                dataset,
+                tokenize_and_align_labels,
+                num_shards=data_args.preprocessing_num_shards,
+                new_fingerprint=fingerprint,
+                features=tokenized_features(dataset),
+                batched=True,
+                batch_size=1000,
+                writer_batch_size=1000,
+                num_proc=data_args.preprocessing_num_workers,
+                load_from_cache_file=not data_args.overwrite_cache,
+                desc=f"Running tokenizer on {desc} dataset",
+            ).with_format()
+        return tokenized_dataset
+
     if training_args.do_train:
         if "train" not in raw_datasets:
             raise ValueError("--do_train requires a train dataset")
         train_dataset = raw_datasets["train"]
         if data_args.max_train_samples is not None:
             train_dataset = train_dataset.select(range(data_args.max_train_samples))
-        with training_args.main_process_first(desc="train dataset map pre-processing"):
-            train_dataset = train_dataset.map(
-                tokenize_and_align_labels,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on train dataset",
-            )
+        train_dataset = tokenize_split(train_dataset, "train")
 
     if training_args.do_eval:
         if "validation" not in raw_datasets:
@@ -651,14 +948,11 @@ def main():
         eval_dataset = raw_datasets["validation"]
         if data_args.max_eval_samples is not None:
             eval_dataset = eval_dataset.select(range(data_args.max_eval_samples))
-        with training_args.main_process_first(desc="validation dataset map pre-processing"):
-            eval_dataset = eval_dataset.map(
-                tokenize_and_align_labels,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on validation dataset",
-            )
+        eval_dataset = tokenize_split(eval_dataset, "validation")
+        # With `--group_by_length`, similar lengths are batched together to pad less. This is opt-in: the seqeval
+        # scores do not depend on the order, but the eval loss averages per-batch losses and so does.
+        if training_args.group_by_length:
+            eval_dataset = eval_dataset.sort(training_args.length_column_name)
 
     if training_args.do_predict:
         if "test" not in raw_datasets:
@@ -666,34 +960,38 @@ def main():
         predict_dataset = raw_datasets["test"]
         if data_args.max_predict_samples is not None:
             predict_dataset = predict_dataset.select(range(data_args.max_predict_samples))
-        with training_args.main_process_first(desc="prediction dataset map pre-processing"):
-            predict_dataset = predict_dataset.map(
-                tokenize_and_align_labels,
-                batched=True,
-                num_proc=data_args.preprocessing_num_workers,
-                load_from_cache_file=not data_args.overwrite_cache,
-                desc="Running tokenizer on prediction dataset",
-            )
+        predict_dataset = tokenize_split(predict_dataset, "prediction")
+        # With `--group_by_length`, predict in order of length to pad less; the original order is restored before the
+        # predictions are written.
+        if training_args.group_by_length:
+            predict_order = np.argsort(predict_dataset[training_args.length_column_name], kind="stable")
+            predict_dataset = predict_dataset.select(predict_order)
+        else:
+            predict_order = np.arange(len(predict_dataset))
 
     # Data collator
-    data_collator = DataCollatorForTokenClassification(tokenizer, pad_to_multiple_of=8 if training_args.fp16 else None)
+    data_collator = TensorCopyTokenClassificationCollator(
+        tokenizer, pad_to_multiple_of=8 if training_args.fp16 else None
+    )
 
-    # Metrics
+    # Metrics, loaded once for all evaluation steps
     metric = load_metric("./metrics/seqeval")
 
+    def remove_ignored_index(ids, labels):
+        """
+        Maps the label ids to their names and drops the positions with an ignored label (special tokens, padding).
+        """
+        mask = labels != -100
+        names = label_arr[np.where(mask, ids, 0)]
+        return [row[row_mask].tolist() for row, row_mask in zip(names, mask)]
+
     def compute_metrics(p):
         predictions, labels = p
         predictions = np.argmax(predictions, axis=2)
 
         # Remove ignored index (special tokens)
-        true_predictions = [
-            [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
-        true_labels = [
-            [label_list[l] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
+        true_predictions = remove_ignored_index(predictions, labels)
+        true_labels = remove_ignored_index(labels, labels)
         results = metric.compute(predictions=true_predictions, references=true_labels)
         if data_args.return_entity_level_metrics:
             # Unpack nested dictionaries
@@ -713,8 +1011,12 @@ def main():
                 "accuracy": results["overall_accuracy"],
             }
 
+    # Collate the batches in worker processes so the GPU does not wait on the main process.
+    if training_args.dataloader_num_workers == 0 and data_args.auto_dataloader_num_workers:
+        training_args.dataloader_num_workers = min(4, (os.cpu_count() or 1) // 2)
+
     # Initialize our Trainer
-    trainer_class = AdapterTrainer if adapter_args.train_adapter else Trainer
+    trainer_class = PrefetchingAdapterTrainer if adapter_args.train_adapter else PrefetchingTrainer
     trainer = trainer_class(
         model=model,
         args=training_args,
@@ -762,23 +1064,21 @@ def main():
         logger.info("*** Predict ***")
 
         predictions, labels, metrics = trainer.predict(predict_dataset, metric_key_prefix="predict")
-        predictions = np.argmax(predictions, axis=2)
-
-        # Remove ignored index (special tokens)
-        true_predictions = [
-            [label_list[p] for (p, l) in zip(prediction, label) if l != -100]
-            for prediction, label in zip(predictions, labels)
-        ]
 
         trainer.log_metrics("predict", metrics)
         trainer.save_metrics("predict", metrics)
 
-        # Save predictions
+        # Save predictions, decoded chunk by chunk in the original order of the examples
         output_predictions_file = os.path.join(training_args.output_dir, "predictions.txt")
         if trainer.is_world_process_zero():
+            # With `--dataloader_drop_last` only the first examples of the (sorted) dataset have predictions.
+            restore_order = np.argsort(predict_order[: len(predictions)], kind="stable")
             with open(output_predictions_file, "w") as writer:
-                for prediction in true_predictions:
-                    writer.write(" ".join(prediction) + "\n")
+                for start in range(0, len(restore_order), 1024):
+                    chunk = restore_order[start : start + 1024]
+                    # Remove ignored index (special tokens)
+                    true_predictions = remove_ignored_index(predictions[chunk].argmax(axis=2), labels[chunk])
+                    writer.writelines(" ".join(prediction) + "\n" for prediction in true_predictions)
 
     kwargs = {"finetuned_from": model_args.model_name_or_path, "tasks": "token-classification"}
     if data_args.dataset_name is not None: